@@ -1,38 +1,113 @@
 """
 Master Pipeline Orchestrator
-Runs all analyses in sequence: RNA-seq → Proteomics → Metabolomics → Integration → Prediction
+Runs all analyses as a dependency graph: RNA-seq / Proteomics / Metabolomics → Pathways / PPI
+→ Integration → Prediction, with each script starting as soon as the outputs it reads exist
 """
 
+import os
 import subprocess
 import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 import time
 
-def run_script(script_path, description):
-    """Run a Python script and report status"""
-    print("\n" + "=" * 70)
-    print(f"RUNNING: {description}")
-    print(f"Script: {script_path.name}")
-    print("=" * 70)
+LOG_DIR = Path("logs")
+
+# Figures are only saved to files, so scripts render with the non-interactive Agg
+# backend unless MPLBACKEND is already set
+SCRIPT_ENV = {**os.environ, "MPLBACKEND": os.environ.get("MPLBACKEND", "Agg")}
+
+# Scripts whose outputs each script reads; scripts with no pending dependencies run concurrently
+DEPENDENCIES = {
+    "01": [],
+    "02": [],
+    "03": [],
+    "04": ["02"],
+    "05": ["02"],
+    "06": ["01", "02", "03", "04"],
+    "07": ["01", "02", "03"],
+    "08": [],
+}
+
+def run_script(script_path, description, log_path=None):
+    """Run a Python script and report status
+
+    The script's stdout/stderr go to log_path (logs/<script>.log by default) rather
+    than the console, so concurrently running scripts do not interleave. Once the
+    script exits, its log is echoed to the console as a single block.
+    """
+    if log_path is None:
+        log_path = LOG_DIR / f"{script_path.stem}.log"
+    print(f"\nStarted: {description} ({script_path.name})")
 
     try:
-        result = subprocess.run(
-            [sys.executable, str(script_path)],
-            cwd=script_path.parent.parent,
-            capture_output=False
-        )
-
-        if result.returncode == 0:
-            print(f"\n✓ {description} - SUCCESS")
-            return True
-        else:
-            print(f"\n✗ {description} - FAILED")
-            return False
-
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(log_path, "w") as log_file:
+            result = subprocess.run(
+                [sys.executable, str(script_path)],
+                cwd=script_path.parent.parent,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                env=SCRIPT_ENV
+            )
+        output = log_path.read_text()
     except Exception as e:
         print(f"\n✗ {description} - ERROR: {e}")
         return False
 
+    success = result.returncode == 0
+    outcome = f"✓ {description} - SUCCESS" if success else f"✗ {description} - FAILED (see {log_path})"
+    print("\n" + "=" * 70 + f"\nRUNNING: {description}\nScript: {script_path.name}\n" + "=" * 70
+          + f"\n{output.rstrip()}\n\n{outcome}")
+    return success
+
+def run_pipeline(scripts, dependencies=DEPENDENCIES, log_dir=LOG_DIR):
+    """Run scripts as soon as all of their dependencies have succeeded
+
+    Returns {script_id: success} for every script that was run. Scripts whose
+    dependencies failed are not run and are left out of the result.
+    """
+    status = {}
+    skipped = set()
+    waiting = {script_id: dependencies.get(script_id, []) for script_id in scripts}
+    running = {}
+
+    max_workers = min(len(scripts), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            # Rescan until no more scripts can be started or skipped
+            progressed = True
+            while progressed:
+                progressed = False
+                for script_id, deps in list(waiting.items()):
+                    blocked = [dep for dep in deps if status.get(dep) is False or dep in skipped]
+                    if blocked:
+                        print(f"\n- Skipping {scripts[script_id][1]} (depends on failed {', '.join(blocked)})")
+                        skipped.add(script_id)
+                        del waiting[script_id]
+                        progressed = True
+                    elif all(status.get(dep) for dep in deps):
+                        del waiting[script_id]
+                        progressed = True
+                        script_path, description = scripts[script_id]
+                        if not script_path.exists():
+                            print(f"\n✗ Script not found: {script_path}")
+                            status[script_id] = False
+                            continue
+                        log_path = log_dir / f"{script_path.stem}.log"
+                        running[executor.submit(run_script, script_path, description, log_path)] = script_id
+
+            if not running:
+                if waiting:
+                    raise ValueError(f"Unsatisfiable script dependencies: {sorted(waiting)}")
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                status[running.pop(future)] = future.result()
+
+    return status
+
 def main():
     print("\n" + "=" * 70)
     print("MULTI-OMICS ANALYSIS PIPELINE")
@@ -40,32 +115,22 @@ def main():
     print("=" * 70)
 
     script_dir = Path("scripts")
-    scripts = [
-        (script_dir / "01_rnaseq_analysis.py", "RNA-seq Analysis (PyDESeq2)"),
-        (script_dir / "02_mass_spec_analysis.py", "Mass Spectrometry / Proteomics Analysis"),
-        (script_dir / "03_metabolomics_integration.py", "Metabolomics Integration"),
-        (script_dir / "04_pathway_mapping.py", "Protein Pathway Mapping (UniProt/KEGG)"),
-        (script_dir / "05_string_interactions.py", "Protein-Protein Interactions (STRING)"),
-        (script_dir / "06_omics_integration.py", "Multi-Omics Integration & Correlation"),
-        (script_dir / "07_predictive_modeling.py", "Predictive Modeling (Machine Learning)"),
-        (script_dir / "08_clinical_trials_search.py", "Clinical Trials Search")
-    ]
-
-    results = {}
-    start_time = time.time()
-
-    for script_path, description in scripts:
-        if not script_path.exists():
-            print(f"\n✗ Script not found: {script_path}")
-            results[description] = False
-            continue
+    scripts = {
+        "01": (script_dir / "01_rnaseq_analysis.py", "RNA-seq Analysis (PyDESeq2)"),
+        "02": (script_dir / "02_mass_spec_analysis.py", "Mass Spectrometry / Proteomics Analysis"),
+        "03": (script_dir / "03_metabolomics_integration.py", "Metabolomics Integration"),
+        "04": (script_dir / "04_pathway_mapping.py", "Protein Pathway Mapping (UniProt/KEGG)"),
+        "05": (script_dir / "05_string_interactions.py", "Protein-Protein Interactions (STRING)"),
+        "06": (script_dir / "06_omics_integration.py", "Multi-Omics Integration & Correlation"),
+        "07": (script_dir / "07_predictive_modeling.py", "Predictive Modeling (Machine Learning)"),
+        "08": (script_dir / "08_clinical_trials_search.py", "Clinical Trials Search")
+    }
 
-        success = run_script(script_path, description)
-        results[description] = success
+    start_time = time.time()
 
-        if not success:
-            print(f"\nPipeline stopped at {description}")
-            break
+    status = run_pipeline(scripts)
+    results = {scripts[script_id][1]: status[script_id] for script_id in scripts if script_id in status}
+    skipped = [scripts[script_id][1] for script_id in scripts if script_id not in status]
 
     # Print summary
     print("\n" + "=" * 70)
@@ -75,10 +140,12 @@ def main():
     for description, success in results.items():
         status = "✓ PASS" if success else "✗ FAIL"
         print(f"{status}: {description}")
+    for description in skipped:
+        print(f"- SKIP: {description}")
 
     total_time = time.time() - start_time
     successful = sum(1 for s in results.values() if s)
-    total = len(results)
+    total = len(scripts)
 
     print(f"\nCompleted: {successful}/{total} analyses")
     print(f"Total time: {total_time/60:.1f} minutes")
@@ -99,16 +166,18 @@ def main():
     """)
 
     print("\nKey output files:")
-    print("  - deseq2_results.csv / significant_genes.csv")
-    print("  - proteomics_results.csv / significant_proteins.csv")
-    print("  - metabolomics_results.csv / significant_metabolites.csv")
-    print("  - protein_pathway_mapping.csv")
-    print("  - string_interactions.csv / ppi_network.png")
+    print("  - deseq2_results.parquet / significant_genes.parquet")
+    print("  - proteomics_results.parquet / significant_proteins.parquet")
+    print("  - metabolomics_results.parquet / significant_metabolites.parquet")
+    print("  - protein_pathway_mapping.parquet")
+    print("  - string_interactions.parquet / ppi_network.png")
     print("  - omics_correlations.csv")
     print("  - model_performance.csv / roc_curves.png")
     print("  - matched_trials.csv / clinical_trials_report.txt")
 
-    return all(results.values())
+    print(f"\nPer-script logs: {LOG_DIR}/")
+
+    return all(results.values()) and not skipped
 
 if __name__ == "__main__":
     success = main()
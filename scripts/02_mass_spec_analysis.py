@@ -8,30 +8,29 @@ import pandas as pd
 from pathlib import Path
 import matplotlib.pyplot as plt
 import seaborn as sns
+from scipy import stats
+
+from pipeline_common import bh_adjust, get_sample_metadata, save_table, top_n, use_cached
 
 # Set up paths
 DATA_DIR = Path("data/raw")
 OUTPUT_DIR = Path("results/mass_spec")
+DATA_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Simplify dense scatter paths when rendering the MA/volcano plots
+plt.rcParams['path.simplify_threshold'] = 1.0
+
 def generate_example_proteomics_data(n_proteins=2000, n_samples=24):
     """
     Generate realistic proteomics intensity data
     Note: Full pyOpenMS requires raw MS files; this simulates processed protein intensities
     """
-    np.random.seed(42)
+    rng = np.random.default_rng(42)
 
     # Sample metadata matching RNA-seq
-    samples = []
-    for i in range(n_samples):
-        condition = "Infected" if i < n_samples // 2 else "Control"
-        samples.append({
-            "sample_id": f"S{i+1:02d}",
-            "condition": condition,
-            "replicate": (i % (n_samples // 2)) + 1
-        })
-
-    metadata = pd.DataFrame(samples)
+    metadata = get_sample_metadata(n_samples)
+    half = n_samples // 2
 
     # Immune-related proteins
     immune_proteins = [
@@ -45,14 +44,14 @@ def generate_example_proteomics_data(n_proteins=2000, n_samples=24):
 
     # Generate intensity matrix (log2 scale, typical for proteomics)
     # Baseline around 10-20 on log2 scale
-    intensities = np.random.normal(15, 2, (n_proteins, n_samples))
+    intensities = rng.normal(15, 2, (n_proteins, n_samples))
 
     # Add differential expression for immune proteins in infected samples
-    for i, protein in enumerate(immune_proteins):
-        protein_idx = protein_names.index(protein)
-        # Higher intensities in infected samples
-        intensities[protein_idx, :n_samples//2] = np.random.normal(20, 1.5, n_samples//2)
-        intensities[protein_idx, n_samples//2:] = np.random.normal(14, 1.5, n_samples//2)
+    # (immune proteins come first in protein_names, so their rows are a leading slice)
+    n_immune = len(immune_proteins)
+    # Higher intensities in infected samples
+    intensities[:n_immune, :half] = rng.normal(20, 1.5, (n_immune, half))
+    intensities[:n_immune, half:] = rng.normal(14, 1.5, (n_immune, n_samples - half))
 
     intensity_df = pd.DataFrame(
         intensities,
@@ -65,41 +64,36 @@ def generate_example_proteomics_data(n_proteins=2000, n_samples=24):
 def analyze_proteomics(metadata, intensity_df, output_dir):
     """Perform differential protein abundance analysis"""
 
-    # Calculate statistics
-    infected_samples = metadata[metadata['condition'] == 'Infected']['sample_id']
-    control_samples = metadata[metadata['condition'] == 'Control']['sample_id']
-
-    results = []
-    for protein in intensity_df.index:
-        infected_vals = intensity_df.loc[protein, infected_samples].values
-        control_vals = intensity_df.loc[protein, control_samples].values
-
-        # Log2 fold change
-        mean_infected = np.mean(infected_vals)
-        mean_control = np.mean(control_vals)
-        log2fc = mean_infected - mean_control
-
-        # T-test
-        from scipy import stats
-        t_stat, p_val = stats.ttest_ind(infected_vals, control_vals)
-
-        # Adjust p-values using Benjamini-Hochberg
-        results.append({
-            'protein': protein,
-            'mean_infected': mean_infected,
-            'mean_control': mean_control,
-            'log2FoldChange': log2fc,
-            'pvalue': p_val,
-            'intensity_infected_sd': np.std(infected_vals),
-            'intensity_control_sd': np.std(control_vals)
-        })
-
-    results_df = pd.DataFrame(results)
-
-    # Adjust p-values
-    from scipy.stats import f as f_dist
-    n = len(results_df)
-    results_df['padj'] = results_df['pvalue'].apply(lambda x: min(x * n, 1.0))
+    # Condition of each intensity column, aligned by sample ID
+    condition = metadata.set_index('sample_id').loc[intensity_df.columns, 'condition'].to_numpy()
+    infected_mask = condition == 'Infected'
+    control_mask = condition == 'Control'
+
+    # Protein x sample matrices for each condition
+    mat = intensity_df.to_numpy()
+    infected_mat = mat[:, infected_mask]
+    control_mat = mat[:, control_mask]
+
+    # Log2 fold change (intensities are already log2-scaled)
+    mean_infected = infected_mat.mean(axis=1)
+    mean_control = control_mat.mean(axis=1)
+    log2fc = mean_infected - mean_control
+
+    # T-test across all proteins at once
+    t_stat, p_val = stats.ttest_ind(infected_mat, control_mat, axis=1, equal_var=True)
+
+    results_df = pd.DataFrame({
+        'protein': intensity_df.index,
+        'mean_infected': mean_infected,
+        'mean_control': mean_control,
+        'log2FoldChange': log2fc,
+        'pvalue': p_val,
+        'intensity_infected_sd': infected_mat.std(axis=1),
+        'intensity_control_sd': control_mat.std(axis=1)
+    })
+
+    # Adjust p-values using Benjamini-Hochberg
+    results_df['padj'] = bh_adjust(results_df['pvalue'])
 
     # Identify significant proteins
     sig_proteins = results_df[
@@ -108,28 +102,34 @@ def analyze_proteomics(metadata, intensity_df, output_dir):
     sig_proteins = sig_proteins.sort_values('padj')
 
     # Save results
-    results_df.to_csv(output_dir / "proteomics_results.csv", index=False)
-    sig_proteins.to_csv(output_dir / "significant_proteins.csv", index=False)
+    save_table(results_df, output_dir / "proteomics_results.parquet")
+    save_table(sig_proteins, output_dir / "significant_proteins.parquet")
 
     print(f"\nProteomics Analysis Results:")
     print(f"Total proteins analyzed: {len(results_df)}")
     print(f"Significant proteins (padj<0.05, |log2FC|>0.5): {len(sig_proteins)}")
     print(f"\nTop 10 upregulated proteins:")
-    print(sig_proteins.nlargest(10, 'log2FoldChange')[['protein', 'log2FoldChange', 'padj']])
+    print(top_n(sig_proteins, 'log2FoldChange')[['protein', 'log2FoldChange', 'padj']])
 
     return results_df, sig_proteins
 
 def create_proteomics_visualizations(intensity_df, metadata, results_df, output_dir):
     """Create proteomics visualization plots"""
 
+    # Plot arrays shared by the MA and volcano plots
+    mean_control = results_df['mean_control'].to_numpy()
+    l2fc = results_df['log2FoldChange'].to_numpy()
+    padj = results_df['padj'].to_numpy()
+    sig_mask = (padj < 0.05) & (np.abs(l2fc) > 0.5)
+    # Clip so that padj == 0 maps to a finite -log10 value
+    neg_log_padj = -np.log10(np.clip(padj, 1e-300, 1.0))
+
     # MA plot
     fig, ax = plt.subplots(figsize=(10, 6))
-    sig_mask = (results_df['padj'] < 0.05) & (abs(results_df['log2FoldChange']) > 0.5)
 
-    ax.scatter(results_df['mean_control'], results_df['log2FoldChange'],
-              alpha=0.5, s=10, label='Not significant')
-    ax.scatter(results_df.loc[sig_mask, 'mean_control'],
-              results_df.loc[sig_mask, 'log2FoldChange'],
+    ax.plot(mean_control, l2fc, '.',
+            markersize=3, alpha=0.5, rasterized=True, label='Not significant')
+    ax.scatter(mean_control[sig_mask], l2fc[sig_mask],
               alpha=0.7, s=20, color='red', label='Significant')
 
     ax.set_xlabel('Mean Intensity (Control)')
@@ -141,14 +141,12 @@ def create_proteomics_visualizations(intensity_df, metadata, results_df, output_
     ax.legend()
     plt.tight_layout()
     plt.savefig(output_dir / 'proteomics_ma_plot.png', dpi=300)
-    plt.close()
 
-    # Volcano plot
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.scatter(-np.log10(results_df['padj']), results_df['log2FoldChange'],
-              alpha=0.5, s=10)
-    ax.scatter(-np.log10(results_df.loc[sig_mask, 'padj']),
-              results_df.loc[sig_mask, 'log2FoldChange'],
+    # Volcano plot (redrawn on the MA plot's figure)
+    ax.clear()
+    ax.plot(neg_log_padj, l2fc, '.',
+            markersize=3, alpha=0.5, rasterized=True)
+    ax.scatter(neg_log_padj[sig_mask], l2fc[sig_mask],
               alpha=0.7, s=20, color='red')
 
     ax.set_xlabel('-log10(adjusted p-value)')
@@ -159,7 +157,7 @@ def create_proteomics_visualizations(intensity_df, metadata, results_df, output_
     ax.axhline(y=-0.5, color='orange', linestyle='--', alpha=0.5)
     plt.tight_layout()
     plt.savefig(output_dir / 'proteomics_volcano_plot.png', dpi=300)
-    plt.close()
+    plt.close(fig)
 
     print(f"Plots saved to {output_dir}")
 
@@ -168,12 +166,18 @@ if __name__ == "__main__":
     print("Mass Spectrometry / Proteomics Analysis")
     print("=" * 60)
 
-    # Generate example data
-    print("\nGenerating example proteomics data...")
-    metadata, intensity_df = generate_example_proteomics_data()
-    metadata.to_csv(DATA_DIR / "proteomics_metadata.csv", index=False)
-    intensity_df.to_csv(DATA_DIR / "proteomics_intensities.csv")
-    print(f"Generated {intensity_df.shape[0]} proteins x {intensity_df.shape[1]} samples")
+    # Load cached input data, generating example data if it is missing
+    intensities_path = DATA_DIR / "proteomics_intensities.parquet"
+    if use_cached(intensities_path):
+        print("\nLoading cached proteomics data...")
+        intensity_df = pd.read_parquet(intensities_path)
+        metadata = get_sample_metadata(intensity_df.shape[1], intensity_df.columns)
+        print(f"Loaded {intensity_df.shape[0]} proteins x {intensity_df.shape[1]} samples")
+    else:
+        print("\nGenerating example proteomics data...")
+        metadata, intensity_df = generate_example_proteomics_data()
+        save_table(intensity_df, intensities_path, index=True)
+        print(f"Generated {intensity_df.shape[0]} proteins x {intensity_df.shape[1]} samples")
 
     # Run analysis
     print("\nAnalyzing proteomics data...")
@@ -10,27 +10,26 @@ import requests
 import json
 import matplotlib.pyplot as plt
 import seaborn as sns
+from scipy import stats
+
+from pipeline_common import bh_adjust, get_sample_metadata, save_table, use_cached
 
 # Set up paths
 DATA_DIR = Path("data/raw")
 OUTPUT_DIR = Path("results/metabolomics")
+DATA_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Simplify dense scatter paths when rendering the MA plot
+plt.rcParams['path.simplify_threshold'] = 1.0
+
 def generate_example_metabolomics_data(n_metabolites=500, n_samples=24):
     """Generate realistic metabolomics data for immune response"""
-    np.random.seed(42)
+    rng = np.random.default_rng(42)
 
     # Sample metadata
-    samples = []
-    for i in range(n_samples):
-        condition = "Infected" if i < n_samples // 2 else "Control"
-        samples.append({
-            "sample_id": f"S{i+1:02d}",
-            "condition": condition,
-            "replicate": (i % (n_samples // 2)) + 1
-        })
-
-    metadata = pd.DataFrame(samples)
+    metadata = get_sample_metadata(n_samples)
+    half = n_samples // 2
 
     # Immune-related metabolites (simplified HMDB IDs)
     immune_metabolites = [
@@ -50,13 +49,12 @@ def generate_example_metabolomics_data(n_metabolites=500, n_samples=24):
     metabolite_ids = immune_metabolites + other_metabolites[:n_metabolites - len(immune_metabolites)]
 
     # Generate abundance data (log2 scale)
-    abundances = np.random.normal(12, 2, (n_metabolites, n_samples))
+    abundances = rng.normal(12, 2, (n_metabolites, n_samples))
 
     # Add differential abundance for immune metabolites
-    for idx, met_id in enumerate(immune_metabolites):
-        if idx < n_metabolites:
-            abundances[idx, :n_samples//2] = np.random.normal(18, 1.5, n_samples//2)
-            abundances[idx, n_samples//2:] = np.random.normal(11, 1.5, n_samples//2)
+    n_immune = min(len(immune_metabolites), n_metabolites)
+    abundances[:n_immune, :half] = rng.normal(18, 1.5, (n_immune, half))
+    abundances[:n_immune, half:] = rng.normal(11, 1.5, (n_immune, n_samples - half))
 
     abundance_df = pd.DataFrame(
         abundances,
@@ -72,7 +70,6 @@ def fetch_hmdb_metadata(metabolite_ids, output_dir):
     In a real scenario, this would query the HMDB API
     For demo, we create example metadata
     """
-    metabolite_info = []
 
     hmdb_data = {
         "HMDB0000148": {"name": "Nitric oxide (NO)", "status": "Detected", "pathway": "Immune response"},
@@ -87,21 +84,18 @@ def fetch_hmdb_metadata(metabolite_ids, output_dir):
         "HMDB0000158": {"name": "Glutamic acid", "status": "Detected", "pathway": "Amino acid metabolism"},
     }
 
-    for met_id in metabolite_ids:
-        if met_id in hmdb_data:
-            info = hmdb_data[met_id].copy()
-            info['metabolite_id'] = met_id
-        else:
-            info = {
-                'metabolite_id': met_id,
-                'name': f"Unknown metabolite {met_id}",
-                'status': 'Detected',
-                'pathway': 'Unknown'
-            }
-        metabolite_info.append(info)
-
-    hmdb_df = pd.DataFrame(metabolite_info)
-    hmdb_df.to_csv(output_dir / "hmdb_metabolite_metadata.csv", index=False)
+    known_df = (pd.DataFrame.from_dict(hmdb_data, orient='index')
+                .rename_axis('metabolite_id').reset_index())
+
+    # Left merge keeps metabolite order; IDs missing from HMDB get defaults
+    hmdb_df = pd.DataFrame({'metabolite_id': metabolite_ids}).merge(
+        known_df, on='metabolite_id', how='left'
+    )
+    hmdb_df['name'] = hmdb_df['name'].fillna('Unknown metabolite ' + hmdb_df['metabolite_id'])
+    hmdb_df['status'] = hmdb_df['status'].fillna('Detected')
+    hmdb_df['pathway'] = hmdb_df['pathway'].fillna('Unknown')
+
+    save_table(hmdb_df, output_dir / "hmdb_metabolite_metadata.parquet")
 
     print(f"Fetched metadata for {len(hmdb_df)} metabolites from HMDB")
     return hmdb_df
@@ -109,38 +103,35 @@ def fetch_hmdb_metadata(metabolite_ids, output_dir):
 def analyze_metabolomics(metadata, abundance_df, output_dir):
     """Perform differential metabolite abundance analysis"""
 
-    infected_samples = metadata[metadata['condition'] == 'Infected']['sample_id']
-    control_samples = metadata[metadata['condition'] == 'Control']['sample_id']
-
-    results = []
-    for metabolite in abundance_df.index:
-        infected_vals = abundance_df.loc[metabolite, infected_samples].values
-        control_vals = abundance_df.loc[metabolite, control_samples].values
+    condition = metadata.set_index('sample_id').loc[abundance_df.columns, 'condition'].to_numpy()
+    infected_mask = condition == 'Infected'
+    control_mask = condition == 'Control'
 
-        mean_infected = np.mean(infected_vals)
-        mean_control = np.mean(control_vals)
-        log2fc = mean_infected - mean_control
+    mat = abundance_df.to_numpy()
+    infected_mat = mat[:, infected_mask]
+    control_mat = mat[:, control_mask]
 
-        from scipy import stats
-        t_stat, p_val = stats.ttest_ind(infected_vals, control_vals)
+    mean_infected = infected_mat.mean(axis=1)
+    mean_control = control_mat.mean(axis=1)
+    log2fc = mean_infected - mean_control
 
-        results.append({
-            'metabolite_id': metabolite,
-            'mean_infected': mean_infected,
-            'mean_control': mean_control,
-            'log2FoldChange': log2fc,
-            'pvalue': p_val
-        })
+    t_stat, p_val = stats.ttest_ind(infected_mat, control_mat, axis=1, equal_var=True)
 
-    results_df = pd.DataFrame(results)
-    results_df['padj'] = results_df['pvalue'].apply(lambda x: min(x * len(results_df), 1.0))
+    results_df = pd.DataFrame({
+        'metabolite_id': abundance_df.index,
+        'mean_infected': mean_infected,
+        'mean_control': mean_control,
+        'log2FoldChange': log2fc,
+        'pvalue': p_val
+    })
+    results_df['padj'] = bh_adjust(results_df['pvalue'])
 
     sig_metabolites = results_df[
         (results_df['padj'] < 0.05) & (abs(results_df['log2FoldChange']) > 0.5)
     ].sort_values('padj')
 
-    results_df.to_csv(output_dir / "metabolomics_results.csv", index=False)
-    sig_metabolites.to_csv(output_dir / "significant_metabolites.csv", index=False)
+    save_table(results_df, output_dir / "metabolomics_results.parquet")
+    save_table(sig_metabolites, output_dir / "significant_metabolites.parquet")
 
     print(f"\nMetabolomics Analysis Results:")
     print(f"Total metabolites analyzed: {len(results_df)}")
@@ -151,13 +142,15 @@ def analyze_metabolomics(metadata, abundance_df, output_dir):
 def create_metabolomics_visualizations(abundance_df, results_df, output_dir):
     """Create metabolomics visualization plots"""
 
-    sig_mask = (results_df['padj'] < 0.05) & (abs(results_df['log2FoldChange']) > 0.5)
+    mean_control = results_df['mean_control'].to_numpy()
+    l2fc = results_df['log2FoldChange'].to_numpy()
+    padj = results_df['padj'].to_numpy()
+    sig_mask = (padj < 0.05) & (np.abs(l2fc) > 0.5)
 
     fig, ax = plt.subplots(figsize=(10, 6))
-    ax.scatter(results_df['mean_control'], results_df['log2FoldChange'],
-              alpha=0.5, s=10, label='Not significant')
-    ax.scatter(results_df.loc[sig_mask, 'mean_control'],
-              results_df.loc[sig_mask, 'log2FoldChange'],
+    ax.plot(mean_control, l2fc, '.',
+            markersize=3, alpha=0.5, rasterized=True, label='Not significant')
+    ax.scatter(mean_control[sig_mask], l2fc[sig_mask],
               alpha=0.7, s=20, color='purple', label='Significant')
 
     ax.set_xlabel('Mean Abundance (Control)')
@@ -169,7 +162,7 @@ def create_metabolomics_visualizations(abundance_df, results_df, output_dir):
     ax.legend()
     plt.tight_layout()
     plt.savefig(output_dir / 'metabolomics_ma_plot.png', dpi=300)
-    plt.close()
+    plt.close(fig)
 
     print(f"Plots saved to {output_dir}")
 
@@ -178,12 +171,19 @@ if __name__ == "__main__":
     print("Metabolomics Integration and Analysis")
     print("=" * 60)
 
-    # Generate example data
-    print("\nGenerating example metabolomics data...")
-    metadata, abundance_df, met_ids = generate_example_metabolomics_data()
-    metadata.to_csv(DATA_DIR / "metabolomics_metadata.csv", index=False)
-    abundance_df.to_csv(DATA_DIR / "metabolomics_abundances.csv")
-    print(f"Generated {abundance_df.shape[0]} metabolites x {abundance_df.shape[1]} samples")
+    # Load cached input data, generating example data if it is missing
+    abundances_path = DATA_DIR / "metabolomics_abundances.parquet"
+    if use_cached(abundances_path):
+        print("\nLoading cached metabolomics data...")
+        abundance_df = pd.read_parquet(abundances_path)
+        metadata = get_sample_metadata(abundance_df.shape[1], abundance_df.columns)
+        met_ids = abundance_df.index.tolist()
+        print(f"Loaded {abundance_df.shape[0]} metabolites x {abundance_df.shape[1]} samples")
+    else:
+        print("\nGenerating example metabolomics data...")
+        metadata, abundance_df, met_ids = generate_example_metabolomics_data()
+        save_table(abundance_df, abundances_path, index=True)
+        print(f"Generated {abundance_df.shape[0]} metabolites x {abundance_df.shape[1]} samples")
 
     # Fetch HMDB metadata
     print("\nFetching HMDB metabolite metadata...")
@@ -3,24 +3,125 @@ Protein Pathway Mapping using UniProt and KEGG
 Connect significant proteins to biological pathways
 """
 
+import hashlib
+import os
 import pandas as pd
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
-import matplotlib.pyplot as plt
 import networkx as nx
-import seaborn as sns
+
+from pipeline_common import network_layout, save_table
 
 # Set up paths
 DATA_DIR = Path("data/raw")
 OUTPUT_DIR = Path("results/pathways")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+API_CACHE_DIR = DATA_DIR / "api_cache"
+
+# Query the live UniProt/KEGG REST APIs instead of the built-in example tables
+USE_LIVE_APIS = os.environ.get("PIPELINE_LIVE_APIS", "0") != "0"
+
+UNIPROT_API = "https://rest.uniprot.org/idmapping"
+KEGG_API = "https://rest.kegg.jp"
 
-def create_uniprot_protein_mapping():
+def make_session():
+    """HTTP session with pooled keep-alive connections and retries on transient errors"""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=retry))
+    return session
+
+def cached_lookup(name, keys, fetch):
+    """
+    Return fetch(keys) as a DataFrame, cached on disk as Parquet
+    The cache file is keyed by a hash of the sorted input keys
+    """
+    digest = hashlib.sha1("\n".join(sorted(keys)).encode()).hexdigest()[:16]
+    cache_path = API_CACHE_DIR / f"{name}_{digest}.parquet"
+    if cache_path.exists():
+        return pd.read_parquet(cache_path)
+
+    result_df = fetch(keys)
+    API_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    result_df.to_parquet(cache_path, compression="zstd", index=False)
+    return result_df
+
+def query_uniprot_idmapping(gene_symbols, session, poll_interval=2, timeout=300):
+    """Map all gene symbols to reviewed human UniProtKB accessions with one ID-mapping job"""
+    response = session.post(f"{UNIPROT_API}/run", data={
+        "ids": ",".join(gene_symbols),
+        "from": "Gene_Name",
+        "to": "UniProtKB",
+        "taxId": "9606",
+    })
+    response.raise_for_status()
+    job_id = response.json()["jobId"]
+
+    # Poll without following the redirect to the (possibly large) results page
+    deadline = time.time() + timeout
+    while True:
+        status = session.get(f"{UNIPROT_API}/status/{job_id}", allow_redirects=False)
+        status.raise_for_status()
+        if status.status_code == 303 or status.json().get("jobStatus") == "FINISHED":
+            break
+        if status.json().get("jobStatus") not in ("NEW", "RUNNING"):
+            raise RuntimeError(f"UniProt ID mapping job {job_id} failed: {status.text}")
+        if time.time() > deadline:
+            raise TimeoutError(f"UniProt ID mapping job {job_id} did not finish in {timeout}s")
+        time.sleep(poll_interval)
+
+    results = session.get(
+        f"{UNIPROT_API}/uniprotkb/results/stream/{job_id}",
+        params={"format": "tsv", "fields": "accession,reviewed"},
+        stream=True,
+    )
+    results.raise_for_status()
+    lines = results.iter_lines(decode_unicode=True)
+    next(lines, None)  # Header: From, Entry, Reviewed
+    rows = [line.split("\t") for line in lines if line]
+    hits = pd.DataFrame(rows, columns=["gene", "uniprot_id", "reviewed"])
+
+    # Prefer Swiss-Prot (reviewed) entries, then the first accession per gene
+    hits = hits.sort_values("reviewed", key=lambda col: col != "reviewed", kind="stable")
+    return hits.drop_duplicates("gene")[["gene", "uniprot_id"]]
+
+def query_kegg_pathways(gene_symbols, session):
+    """Fetch KEGG pathways for gene symbols using the bulk human list/link endpoints"""
+    def fetch_table(path):
+        response = session.get(f"{KEGG_API}/{path}")
+        response.raise_for_status()
+        return [line.split("\t") for line in response.text.splitlines() if line]
+
+    # hsa:<entrez id> -> gene symbol (first symbol before the description)
+    symbols = {fields[0]: fields[-1].split(";")[0].split(",")[0].strip()
+               for fields in fetch_table("list/hsa")}
+    # hsa04620 -> "hsa04620: Toll-like receptor signaling pathway"
+    names = {fields[0]: f"{fields[0]}: {fields[1].split(' - Homo sapiens')[0]}"
+             for fields in fetch_table("list/pathway/hsa")}
+
+    links = pd.DataFrame(fetch_table("link/pathway/hsa"), columns=["kegg_id", "pathway_id"])
+    links["gene"] = links["kegg_id"].map(symbols)
+    links["pathway"] = links["pathway_id"].str.removeprefix("path:").map(names)
+    links = links[links["gene"].isin(set(gene_symbols))].dropna(subset=["pathway"])
+    return links[["gene", "pathway"]]
+
+def create_uniprot_protein_mapping(gene_symbols=None):
     """
     Create mapping of gene symbols to UniProt IDs
-    In real scenario, would query UniProt API
+    Queries the UniProt ID-mapping API when PIPELINE_LIVE_APIS=1, otherwise uses example IDs
     """
+    if USE_LIVE_APIS and gene_symbols is not None:
+        try:
+            with make_session() as session:
+                hits = cached_lookup("uniprot", list(gene_symbols),
+                                     lambda genes: query_uniprot_idmapping(genes, session))
+            return dict(zip(hits["gene"], hits["uniprot_id"]))
+        except (requests.RequestException, RuntimeError, TimeoutError) as e:
+            print(f"UniProt query failed ({e}); using example mapping")
+
     # Example mapping for immune-related proteins
     uniprot_mapping = {
         "IL6": "P05231",      # Interleukin-6
@@ -48,8 +149,17 @@ def create_uniprot_protein_mapping():
 def fetch_kegg_pathways(gene_symbols):
     """
     Fetch KEGG pathway annotations for genes
-    In real scenario, would query KEGG API
+    Queries the KEGG REST API when PIPELINE_LIVE_APIS=1, otherwise uses example pathways
     """
+    if USE_LIVE_APIS:
+        try:
+            with make_session() as session:
+                links = cached_lookup("kegg", list(gene_symbols),
+                                      lambda genes: query_kegg_pathways(genes, session))
+            return links.groupby("gene", sort=False)["pathway"].agg(list).to_dict()
+        except requests.RequestException as e:
+            print(f"KEGG query failed ({e}); using example pathways")
+
     kegg_pathways = {
         "IL6": ["hsa04620: Toll-like receptor signaling pathway",
                 "hsa04060: Cytokine-cytokine receptor interaction"],
@@ -75,39 +185,31 @@ def map_proteins_to_pathways(sig_proteins_df, uniprot_mapping, output_dir):
 
     kegg_pathways = fetch_kegg_pathways(sig_proteins_df['protein'].unique())
 
-    pathway_mapping = []
-    for _, row in sig_proteins_df.iterrows():
-        protein = row['protein']
-
-        uniprot_id = uniprot_mapping.get(protein, "Unknown")
+    # One row per (protein, pathway) annotation
+    pathway_df = pd.DataFrame(
+        [(protein, pathway) for protein, pathways in kegg_pathways.items() for pathway in pathways],
+        columns=['protein', 'pathway']
+    )
 
-        pathways = kegg_pathways.get(protein, [])
+    def annotate(proteins_df):
+        mapped = proteins_df[['protein', 'log2FoldChange', 'padj']].merge(pathway_df, on='protein')
+        mapped['uniprot_id'] = mapped['protein'].map(uniprot_mapping).fillna("Unknown")
+        return mapped[['protein', 'uniprot_id', 'pathway', 'log2FoldChange', 'padj']]
 
-        for pathway in pathways:
-            pathway_mapping.append({
-                'protein': protein,
-                'uniprot_id': uniprot_id,
-                'pathway': pathway,
-                'log2FoldChange': row['log2FoldChange'],
-                'padj': row['padj']
-            })
+    mapping_df = annotate(sig_proteins_df)
 
-    if not pathway_mapping:
+    if mapping_df.empty:
         # Add some pathways for key proteins even if not in sig list
-        for protein in ['IL6', 'TNF', 'IFNG', 'NFKB1', 'STAT1']:
-            uniprot_id = uniprot_mapping.get(protein, "Unknown")
-            pathways = kegg_pathways.get(protein, [])
-            for pathway in pathways:
-                pathway_mapping.append({
-                    'protein': protein,
-                    'uniprot_id': uniprot_id,
-                    'pathway': pathway,
-                    'log2FoldChange': 2.0,
-                    'padj': 0.001
-                })
-
-    mapping_df = pd.DataFrame(pathway_mapping)
-    mapping_df.to_csv(output_dir / "protein_pathway_mapping.csv", index=False)
+        mapping_df = annotate(pd.DataFrame({
+            'protein': ['IL6', 'TNF', 'IFNG', 'NFKB1', 'STAT1'],
+            'log2FoldChange': 2.0,
+            'padj': 0.001
+        }))
+
+    # Few distinct labels repeat across rows; categorical codes make nunique/value_counts cheap
+    mapping_df = mapping_df.astype({'protein': 'category', 'uniprot_id': 'category',
+                                    'pathway': 'category'})
+    save_table(mapping_df, output_dir / "protein_pathway_mapping.parquet")
 
     print(f"\nPathway Mapping Results:")
     print(f"Proteins mapped: {mapping_df['protein'].nunique()}")
@@ -120,26 +222,27 @@ def map_proteins_to_pathways(sig_proteins_df, uniprot_mapping, output_dir):
 
 def create_pathway_network(mapping_df, output_dir):
     """Create protein-pathway interaction network"""
+    import matplotlib.pyplot as plt  # Deferred so the mapping steps start without it
 
     G = nx.Graph()
 
     # Add nodes
-    for protein in mapping_df['protein'].unique():
-        G.add_node(protein, node_type='protein')
+    G.add_nodes_from(mapping_df['protein'].unique(), node_type='protein')
 
-    pathway_names = mapping_df['pathway'].str.extract(r'(hsa\d+: [^,]+)')[0].unique()
-    for pathway in pathway_names:
-        G.add_node(pathway, node_type='pathway')
+    # Pathway labels ("hsa04620: <name>") are used as node keys as-is
+    G.add_nodes_from(mapping_df['pathway'].unique(), node_type='pathway')
 
     # Add edges
-    for _, row in mapping_df.iterrows():
-        pathway = row['pathway'].split(':')[0] + ': ' + row['pathway'].split(': ')[1] if ': ' in row['pathway'] else row['pathway']
-        G.add_edge(row['protein'], pathway, weight=abs(row['log2FoldChange']))
+    G.add_edges_from(zip(
+        mapping_df['protein'],
+        mapping_df['pathway'],
+        ({'weight': w} for w in mapping_df['log2FoldChange'].abs())
+    ))
 
     # Visualize network
     fig, ax = plt.subplots(figsize=(14, 10))
 
-    pos = nx.spring_layout(G, k=2, iterations=50, seed=42)
+    pos = network_layout(G, seed=42)
 
     # Draw proteins and pathways with different colors
     protein_nodes = [n for n, attr in G.nodes(data=True) if attr.get('node_type') == 'protein']
@@ -158,12 +261,13 @@ def create_pathway_network(mapping_df, output_dir):
     ax.axis('off')
 
     plt.tight_layout()
-    plt.savefig(output_dir / 'protein_pathway_network.png', dpi=300, bbox_inches='tight')
+    plt.savefig(output_dir / 'protein_pathway_network.png', dpi=150)
     plt.close()
 
     print(f"Network visualization saved")
 
 if __name__ == "__main__":
+
     print("=" * 60)
     print("Protein Pathway Mapping (UniProt/KEGG)")
     print("=" * 60)
@@ -171,7 +275,8 @@ if __name__ == "__main__":
     # Load significant proteins from proteomics analysis
     print("\nLoading significant proteins...")
     try:
-        sig_proteins_df = pd.read_csv(Path("results/mass_spec/significant_proteins.csv"))
+        sig_proteins_df = pd.read_parquet(Path("results/mass_spec/significant_proteins.parquet"),
+                                          columns=['protein', 'log2FoldChange', 'padj'])
         print(f"Loaded {len(sig_proteins_df)} significant proteins")
     except FileNotFoundError:
         print("Significant proteins file not found. Using example proteins.")
@@ -183,7 +288,7 @@ if __name__ == "__main__":
 
     # Get UniProt mapping
     print("\nFetching UniProt protein IDs...")
-    uniprot_mapping = create_uniprot_protein_mapping()
+    uniprot_mapping = create_uniprot_protein_mapping(sig_proteins_df['protein'].unique())
 
     # Map to pathways
     print("Mapping proteins to KEGG pathways...")
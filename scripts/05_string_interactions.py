@@ -3,52 +3,104 @@ Protein-Protein Interaction Analysis using STRING
 Identify interaction networks among significant proteins
 """
 
+import numpy as np
 import pandas as pd
 import networkx as nx
 from pathlib import Path
-import matplotlib.pyplot as plt
 import requests
 import json
 
+from pipeline_common import network_layout, save_table
+
+try:
+    import igraph as ig
+except ImportError:
+    ig = None  # Fall back to the NetworkX implementations
+
 # Set up paths
 OUTPUT_DIR = Path("results/interactions")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Example PPI network data as aligned arrays: interacting pairs, combined score, nscore
+STRING_PAIRS = np.array([
+    ["IL6", "STAT3"], ["IL6", "JAK1"], ["TNF", "NFKB1"], ["TNF", "MAPK1"],
+    ["IFNG", "STAT1"], ["NFKB1", "RELA"], ["JAK1", "STAT1"], ["JAK2", "STAT1"],
+    ["MAPK1", "ERK2"], ["TLR4", "MYD88"], ["IL1B", "IL1R1"], ["CD4", "LCK"],
+    ["CD8A", "LCK"],
+])
+STRING_SCORES = np.array([0.999, 0.998, 0.999, 0.997, 0.999, 0.999, 0.999,
+                          0.999, 0.999, 0.999, 0.999, 0.999, 0.998])
+STRING_NSCORES = np.array([0.995, 0.990, 0.998, 0.985, 0.999, 0.998, 0.997,
+                           0.998, 0.999, 0.997, 0.999, 0.995, 0.990])
+
 def query_string_api(proteins, species="9606"):
     """
     Query STRING API for protein-protein interactions
     species="9606" for Homo sapiens
     In production, would make actual API calls with proper rate limiting
+    Returns a DataFrame of the interactions whose partners are both in proteins
     """
 
-    # Example PPI network data
-    string_interactions = {
-        ("IL6", "STAT3"): {"score": 0.999, "nscore": 0.995},
-        ("IL6", "JAK1"): {"score": 0.998, "nscore": 0.990},
-        ("TNF", "NFKB1"): {"score": 0.999, "nscore": 0.998},
-        ("TNF", "MAPK1"): {"score": 0.997, "nscore": 0.985},
-        ("IFNG", "STAT1"): {"score": 0.999, "nscore": 0.999},
-        ("NFKB1", "RELA"): {"score": 0.999, "nscore": 0.998},
-        ("JAK1", "STAT1"): {"score": 0.999, "nscore": 0.997},
-        ("JAK2", "STAT1"): {"score": 0.999, "nscore": 0.998},
-        ("MAPK1", "ERK2"): {"score": 0.999, "nscore": 0.999},
-        ("TLR4", "MYD88"): {"score": 0.999, "nscore": 0.997},
-        ("IL1B", "IL1R1"): {"score": 0.999, "nscore": 0.999},
-        ("CD4", "LCK"): {"score": 0.999, "nscore": 0.995},
-        ("CD8A", "LCK"): {"score": 0.998, "nscore": 0.990},
-    }
-
-    interactions = []
-    for (prot1, prot2), scores in string_interactions.items():
-        if prot1 in proteins and prot2 in proteins:
-            interactions.append({
-                'protein1': prot1,
-                'protein2': prot2,
-                'combined_score': scores['score'],
-                'nscore': scores['nscore']
-            })
-
-    return interactions
+    # Keep pairs with both partners among the query proteins
+    in_query = np.isin(STRING_PAIRS, list(proteins))
+    mask = in_query[:, 0] & in_query[:, 1]
+
+    return pd.DataFrame({
+        'protein1': STRING_PAIRS[mask, 0],
+        'protein2': STRING_PAIRS[mask, 1],
+        'combined_score': STRING_SCORES[mask],
+        'nscore': STRING_NSCORES[mask]
+    })
+
+def to_igraph(G):
+    """Convert a NetworkX graph to igraph, keeping node order and names in vs['name']"""
+    index = {node: i for i, node in enumerate(G.nodes())}
+    g = ig.Graph(n=len(index), edges=[(index[u], index[v]) for u, v in G.edges()])
+    g.vs['name'] = list(index)
+    return g
+
+def igraph_centrality(G):
+    """Degree, betweenness and closeness centrality via igraph, scaled as in NetworkX"""
+    g = to_igraph(G)
+    n = g.vcount()
+
+    degree = np.array(g.degree())
+    betweenness = np.array(g.betweenness(directed=False)) * 2 / ((n - 1) * (n - 2))
+
+    # igraph closeness only averages over reachable nodes; apply the Wasserman-Faust
+    # scaling NetworkX uses so disconnected graphs give the same values
+    components = g.connected_components()
+    component_size = np.array(components.sizes())[components.membership]
+    closeness = np.nan_to_num(np.array(g.closeness(), dtype=float))
+    closeness *= (component_size - 1) / (n - 1)
+
+    return pd.DataFrame({
+        'protein': g.vs['name'],
+        'degree': degree,
+        'degree_centrality': degree / (n - 1),
+        'betweenness_centrality': betweenness,
+        'closeness_centrality': closeness
+    })
+
+def csgraph_closeness(G):
+    """Closeness centrality from SciPy's C shortest paths, scaled as in NetworkX"""
+    from scipy.sparse.csgraph import shortest_path
+
+    n = G.number_of_nodes()
+    if n < 2:
+        return dict.fromkeys(G.nodes(), 0.0)
+
+    dist = shortest_path(nx.to_scipy_sparse_array(G, weight=None, format='csr'),
+                         directed=False, unweighted=True)
+    reachable = np.isfinite(dist)
+    n_reached = reachable.sum(axis=1) - 1
+    total_dist = np.where(reachable, dist, 0).sum(axis=1)
+
+    # Wasserman-Faust scaling for disconnected graphs, as in nx.closeness_centrality
+    with np.errstate(divide='ignore', invalid='ignore'):
+        closeness = np.where(total_dist > 0,
+                             n_reached / total_dist * n_reached / (n - 1), 0.0)
+    return dict(zip(G.nodes(), closeness))
 
 def analyze_ppi_network(sig_proteins_df, output_dir):
     """Analyze protein-protein interaction network"""
@@ -56,23 +108,20 @@ def analyze_ppi_network(sig_proteins_df, output_dir):
     proteins = sig_proteins_df['protein'].tolist()
 
     print(f"\nQuerying STRING for {len(proteins)} proteins...")
-    interactions = query_string_api(proteins)
+    interactions_df = query_string_api(proteins)
 
-    if not interactions:
+    if interactions_df.empty:
         # Add default interactions if none found
         print("No interactions found in filtered list, adding examples...")
-        default_proteins = ['IL6', 'TNF', 'IFNG', 'NFKB1', 'STAT1', 'JAK1', 'JAK2']
-        interactions = [
-            {'protein1': 'IL6', 'protein2': 'JAK1', 'combined_score': 0.999, 'nscore': 0.995},
-            {'protein1': 'TNF', 'protein2': 'NFKB1', 'combined_score': 0.999, 'nscore': 0.998},
-            {'protein1': 'IFNG', 'protein2': 'STAT1', 'combined_score': 0.999, 'nscore': 0.999},
-            {'protein1': 'JAK1', 'protein2': 'STAT1', 'combined_score': 0.999, 'nscore': 0.997},
-            {'protein1': 'JAK2', 'protein2': 'STAT1', 'combined_score': 0.999, 'nscore': 0.998},
-        ]
-
-    interactions_df = pd.DataFrame(interactions)
+        interactions_df = pd.DataFrame({
+            'protein1': ['IL6', 'TNF', 'IFNG', 'JAK1', 'JAK2'],
+            'protein2': ['JAK1', 'NFKB1', 'STAT1', 'STAT1', 'STAT1'],
+            'combined_score': [0.999, 0.999, 0.999, 0.999, 0.999],
+            'nscore': [0.995, 0.998, 0.999, 0.997, 0.998]
+        })
+
     interactions_df = interactions_df.sort_values('combined_score', ascending=False)
-    interactions_df.to_csv(output_dir / "string_interactions.csv", index=False)
+    save_table(interactions_df, output_dir / "string_interactions.parquet")
 
     print(f"\nProtein-Protein Interactions Found:")
     print(f"Total interactions: {len(interactions_df)}")
@@ -82,22 +131,22 @@ def analyze_ppi_network(sig_proteins_df, output_dir):
 
 def build_interaction_network(sig_proteins_df, interactions_df, output_dir):
     """Build and visualize PPI network"""
+    import matplotlib.pyplot as plt  # Deferred so the STRING queries start without it
 
-    G = nx.Graph()
+    # Build the graph from the edge list in one pass; weight and score both
+    # carry the STRING combined score
+    G = nx.from_pandas_edgelist(
+        interactions_df.assign(weight=interactions_df['combined_score'],
+                               score=interactions_df['combined_score']),
+        source='protein1', target='protein2', edge_attr=['weight', 'score']
+    )
 
     # Get protein info from sig_proteins_df
-    protein_fc = dict(zip(sig_proteins_df['protein'], sig_proteins_df['log2FoldChange']))
+    protein_fc = sig_proteins_df.set_index('protein')['log2FoldChange'].to_dict()
 
-    # Add nodes
-    for protein in sig_proteins_df['protein']:
-        fc = protein_fc.get(protein, 0)
-        G.add_node(protein, log2fc=fc)
-
-    # Add edges
-    for _, row in interactions_df.iterrows():
-        G.add_edge(row['protein1'], row['protein2'],
-                  weight=row['combined_score'],
-                  score=row['combined_score'])
+    # Add nodes, including significant proteins without interactions
+    G.add_nodes_from(protein_fc)
+    nx.set_node_attributes(G, protein_fc, 'log2fc')
 
     # Calculate network statistics
     print(f"\nNetwork Statistics:")
@@ -110,8 +159,11 @@ def build_interaction_network(sig_proteins_df, interactions_df, output_dir):
 
         # Find communities/clusters
         try:
-            from networkx.algorithms import community
-            communities = list(community.greedy_modularity_communities(G))
+            if ig is not None:
+                communities = to_igraph(G).community_multilevel()
+            else:
+                from networkx.algorithms import community
+                communities = list(community.greedy_modularity_communities(G))
             print(f"Number of communities: {len(communities)}")
         except:
             print("Community detection not available")
@@ -121,20 +173,24 @@ def build_interaction_network(sig_proteins_df, interactions_df, output_dir):
 
     if G.number_of_nodes() > 0:
         # Layout
-        pos = nx.spring_layout(G, k=2, iterations=50, seed=42)
+        pos = network_layout(G, seed=42)
+
+        # log2FC per node in G.nodes() order (0 for interaction partners not in sig list)
+        node_fc = np.fromiter((fc for _, fc in G.nodes(data='log2fc', default=0)),
+                              dtype=np.float32, count=G.number_of_nodes())
 
         # Node sizes based on log2FC
-        node_sizes = [300 + abs(G.nodes[node].get('log2fc', 0)) * 100 for node in G.nodes()]
+        node_sizes = 300 + np.abs(node_fc) * 100
 
         # Node colors based on log2FC (red for upregulated, blue for downregulated)
-        node_colors = [G.nodes[node].get('log2fc', 0) for node in G.nodes()]
+        node_colors = node_fc
 
         nodes = nx.draw_networkx_nodes(G, pos, node_size=node_sizes, node_color=node_colors,
                                        cmap='RdBu_r', vmin=-3, vmax=3, ax=ax)
 
         # Draw edges with width based on interaction score
-        edge_weights = [G[u][v]['weight'] for u, v in G.edges()]
-        edges = nx.draw_networkx_edges(G, pos, width=[w*3 for w in edge_weights],
+        edge_weights = np.fromiter(nx.get_edge_attributes(G, 'weight').values(), dtype=float)
+        edges = nx.draw_networkx_edges(G, pos, width=edge_weights * 3,
                                        alpha=0.6, ax=ax)
 
         nx.draw_networkx_labels(G, pos, font_size=10, font_weight='bold', ax=ax)
@@ -150,7 +206,7 @@ def build_interaction_network(sig_proteins_df, interactions_df, output_dir):
         ax.axis('off')
 
     plt.tight_layout()
-    plt.savefig(output_dir / 'ppi_network.png', dpi=300, bbox_inches='tight')
+    plt.savefig(output_dir / 'ppi_network.png', dpi=150)
     plt.close()
 
     print(f"Network visualization saved")
@@ -164,24 +220,28 @@ def identify_hub_proteins(G, output_dir):
         print("No nodes in network")
         return pd.DataFrame()
 
-    # Calculate centrality measures
-    degree_centrality = nx.degree_centrality(G)
-    betweenness_centrality = nx.betweenness_centrality(G)
-    closeness_centrality = nx.closeness_centrality(G)
-
-    hub_data = []
-    for node in G.nodes():
-        hub_data.append({
-            'protein': node,
-            'degree': G.degree(node),
-            'degree_centrality': degree_centrality.get(node, 0),
-            'betweenness_centrality': betweenness_centrality.get(node, 0),
-            'closeness_centrality': closeness_centrality.get(node, 0)
-        })
+    # Calculate centrality measures (igraph when available, as it runs in C)
+    if ig is not None and G.number_of_nodes() > 2:
+        hub_df = igraph_centrality(G)
+    else:
+        degree_centrality = nx.degree_centrality(G)
+        betweenness_centrality = nx.betweenness_centrality(G)
+        closeness_centrality = csgraph_closeness(G)
+
+        hub_data = []
+        for node in G.nodes():
+            hub_data.append({
+                'protein': node,
+                'degree': G.degree(node),
+                'degree_centrality': degree_centrality.get(node, 0),
+                'betweenness_centrality': betweenness_centrality.get(node, 0),
+                'closeness_centrality': closeness_centrality.get(node, 0)
+            })
+
+        hub_df = pd.DataFrame(hub_data)
 
-    hub_df = pd.DataFrame(hub_data)
     hub_df = hub_df.sort_values('degree', ascending=False)
-    hub_df.to_csv(output_dir / "hub_proteins.csv", index=False)
+    save_table(hub_df, output_dir / "hub_proteins.parquet")
 
     print(f"\nTop Hub Proteins (by degree):")
     print(hub_df.head(10))
@@ -189,6 +249,7 @@ def identify_hub_proteins(G, output_dir):
     return hub_df
 
 if __name__ == "__main__":
+
     print("=" * 60)
     print("Protein-Protein Interaction Analysis (STRING)")
     print("=" * 60)
@@ -196,7 +257,8 @@ if __name__ == "__main__":
     # Load significant proteins
     print("\nLoading significant proteins...")
     try:
-        sig_proteins_df = pd.read_csv(Path("results/mass_spec/significant_proteins.csv"))
+        sig_proteins_df = pd.read_parquet(Path("results/mass_spec/significant_proteins.parquet"),
+                                          columns=['protein', 'log2FoldChange', 'padj'])
         print(f"Loaded {len(sig_proteins_df)} significant proteins")
     except FileNotFoundError:
         print("Significant proteins file not found. Using example proteins.")
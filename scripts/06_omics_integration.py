@@ -6,37 +6,57 @@ Correlate RNA-seq, proteomics, and metabolomics layers
 import numpy as np
 import pandas as pd
 from pathlib import Path
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy.stats import pearsonr, spearmanr
-import statsmodels.api as sm
-from statsmodels.formula.api import ols
-from statsmodels.stats.anova import anova_lm
+from scipy import stats
 
 # Set up paths
 OUTPUT_DIR = Path("results/integration")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+def correlate(a, b):
+    """Pearson and Spearman correlation of two aligned arrays
+
+    Returns (pearson_r, pearson_p, spearman_r, spearman_p), with two-sided p-values
+    from the t distribution as in scipy.stats.pearsonr/spearmanr.
+    """
+    def r_and_p(x, y):
+        n = len(x)
+        r = float(np.clip(np.corrcoef(x, y)[0, 1], -1.0, 1.0))
+        if n < 3:
+            return r, 1.0
+        with np.errstate(divide='ignore'):
+            t = r * np.sqrt((n - 2) / (1 - r ** 2))
+        return r, float(2 * stats.t.sf(abs(t), n - 2))
+
+    pearson_r, pearson_p = r_and_p(a, b)
+    spearman_r, spearman_p = r_and_p(stats.rankdata(a), stats.rankdata(b))
+    return pearson_r, pearson_p, spearman_r, spearman_p
+
 def load_omics_data():
-    """Load processed results from all omics analyses"""
+    """Load processed results from all omics analyses
+
+    Only the log2 fold changes (and their feature IDs) are read from each table.
+    """
 
     data = {}
 
     try:
-        data['rnaseq'] = pd.read_csv(Path("results/rna_seq/deseq2_results.csv"), index_col=0)
+        data['rnaseq'] = pd.read_parquet(Path("results/rna_seq/deseq2_results.parquet"),
+                                         columns=['log2FoldChange'])
         print("Loaded RNA-seq results")
     except FileNotFoundError:
         print("RNA-seq results not found")
 
     try:
-        data['proteomics'] = pd.read_csv(Path("results/mass_spec/proteomics_results.csv"))
+        data['proteomics'] = pd.read_parquet(Path("results/mass_spec/proteomics_results.parquet"),
+                                             columns=['protein', 'log2FoldChange'])
         data['proteomics'] = data['proteomics'].set_index('protein')
         print("Loaded proteomics results")
     except FileNotFoundError:
         print("Proteomics results not found")
 
     try:
-        data['metabolomics'] = pd.read_csv(Path("results/metabolomics/metabolomics_results.csv"))
+        data['metabolomics'] = pd.read_parquet(Path("results/metabolomics/metabolomics_results.parquet"),
+                                               columns=['metabolite_id', 'log2FoldChange'])
         data['metabolomics'] = data['metabolomics'].set_index('metabolite_id')
         print("Loaded metabolomics results")
     except FileNotFoundError:
@@ -63,15 +83,14 @@ def correlate_omics_layers(output_dir):
         print("\nCorrelating RNA-seq vs Proteomics...")
 
         # Find common genes/proteins
-        common = list(set(rnaseq.index) & set(proteomics.index))
+        common = rnaseq.index.intersection(proteomics.index)
         print(f"Found {len(common)} common features")
 
         if len(common) > 1:
-            rnaseq_fc = rnaseq.loc[common, 'log2FoldChange'].values
-            prot_fc = proteomics.loc[common, 'log2FoldChange'].values
+            rnaseq_fc = rnaseq['log2FoldChange'].reindex(common).to_numpy()
+            prot_fc = proteomics['log2FoldChange'].reindex(common).to_numpy()
 
-            pearson_r, pearson_p = pearsonr(rnaseq_fc, prot_fc)
-            spearman_r, spearman_p = spearmanr(rnaseq_fc, prot_fc)
+            pearson_r, pearson_p, spearman_r, spearman_p = correlate(rnaseq_fc, prot_fc)
 
             correlation_results.append({
                 'comparison': 'RNA-seq vs Proteomics',
@@ -86,13 +105,15 @@ def correlate_omics_layers(output_dir):
             print(f"Spearman r={spearman_r:.4f}, p={spearman_p:.4e}")
 
             # Plot correlation
+            import matplotlib.pyplot as plt  # Only needed when there is something to plot
+
             fig, ax = plt.subplots(figsize=(10, 8))
             ax.scatter(rnaseq_fc, prot_fc, alpha=0.6, s=100)
 
-            # Add regression line
-            z = np.polyfit(rnaseq_fc, prot_fc, 1)
-            p = np.poly1d(z)
-            ax.plot(rnaseq_fc, p(rnaseq_fc), "r--", alpha=0.8, linewidth=2)
+            # Add least-squares regression line (slope = r * sd_y / sd_x)
+            slope = pearson_r * prot_fc.std() / rnaseq_fc.std()
+            intercept = prot_fc.mean() - slope * rnaseq_fc.mean()
+            ax.plot(rnaseq_fc, slope * rnaseq_fc + intercept, "r--", alpha=0.8, linewidth=2)
 
             ax.set_xlabel('RNA-seq log2(Fold Change)', fontsize=12)
             ax.set_ylabel('Proteomics log2(Fold Change)', fontsize=12)
@@ -101,7 +122,7 @@ def correlate_omics_layers(output_dir):
             ax.grid(True, alpha=0.3)
 
             plt.tight_layout()
-            plt.savefig(output_dir / 'rnaseq_vs_proteomics_correlation.png', dpi=300)
+            plt.savefig(output_dir / 'rnaseq_vs_proteomics_correlation.png', dpi=150)
             plt.close()
 
     # Proteomics vs Metabolomics correlation
@@ -113,12 +134,11 @@ def correlate_omics_layers(output_dir):
 
         # Simulate pathway-based associations
         n_common = min(5, len(proteomics), len(metabolomics))
-        prot_sample = proteomics['log2FoldChange'].iloc[:n_common].values
-        met_sample = metabolomics['log2FoldChange'].iloc[:n_common].values
+        prot_sample = proteomics['log2FoldChange'].iloc[:n_common].to_numpy()
+        met_sample = metabolomics['log2FoldChange'].iloc[:n_common].to_numpy()
 
         if n_common > 1:
-            pearson_r, pearson_p = pearsonr(prot_sample, met_sample)
-            spearman_r, spearman_p = spearmanr(prot_sample, met_sample)
+            pearson_r, pearson_p, spearman_r, spearman_p = correlate(prot_sample, met_sample)
 
             correlation_results.append({
                 'comparison': 'Proteomics vs Metabolomics',
@@ -143,11 +163,13 @@ def analyze_pathway_associations(output_dir):
     """Analyze associations between proteins and metabolites in pathways"""
 
     try:
-        pathway_mapping = pd.read_csv(Path("results/pathways/protein_pathway_mapping.csv"))
+        # pathway is stored as a categorical, so it loads as one
+        pathway_mapping = pd.read_parquet(Path("results/pathways/protein_pathway_mapping.parquet"),
+                                          columns=['protein', 'pathway', 'log2FoldChange'])
         print("\nLoaded pathway mapping information")
 
         # Summarize by pathway
-        pathway_summary = pathway_mapping.groupby('pathway').agg({
+        pathway_summary = pathway_mapping.groupby('pathway', observed=True).agg({
             'protein': 'count',
             'log2FoldChange': ['mean', 'std']
         }).round(3)
@@ -174,8 +196,8 @@ def perform_anova_analysis(output_dir):
 
     try:
         # Load raw count data
-        rnaseq_df = pd.read_csv(Path("data/raw/rnaseq_counts.csv"), index_col=0)
-        metadata = pd.read_csv(Path("data/raw/rnaseq_metadata.csv"))
+        rnaseq_df = pd.read_parquet(Path("data/raw/rnaseq_counts.parquet"))
+        metadata = pd.read_parquet(Path("data/raw/sample_metadata.parquet"))
 
         print(f"\nTesting condition effects on RNA-seq data...")
 
@@ -183,32 +205,18 @@ def perform_anova_analysis(output_dir):
         rnaseq_means = rnaseq_df.mean(axis=1)
         top_genes = rnaseq_means.nlargest(10).index
 
-        anova_results = []
-
-        for gene in top_genes:
-            gene_expr = rnaseq_df.loc[gene]
-
-            # Create dataframe for analysis
-            analysis_data = pd.DataFrame({
-                'expression': gene_expr.values,
-                'condition': metadata['condition'].values
-            })
-
-            # Perform ANOVA
-            model = ols('expression ~ C(condition)', data=analysis_data).fit()
-            anova_table = anova_lm(model, typ=2)
-
-            f_stat = anova_table.loc['C(condition)', 'F']
-            p_val = anova_table.loc['C(condition)', 'PR(>F)']
-
-            anova_results.append({
-                'gene': gene,
-                'f_statistic': f_stat,
-                'p_value': p_val,
-                'significant': p_val < 0.05
-            })
-
-        anova_df = pd.DataFrame(anova_results)
+        # One-way ANOVA for all selected genes at once: one sample group per condition
+        condition = metadata.set_index('sample_id').loc[rnaseq_df.columns, 'condition'].to_numpy()
+        expr = rnaseq_df.loc[top_genes].to_numpy(dtype=float)
+        groups = [expr[:, condition == level] for level in pd.unique(condition)]
+        f_stat, p_val = stats.f_oneway(*groups, axis=1)
+
+        anova_df = pd.DataFrame({
+            'gene': top_genes,
+            'f_statistic': f_stat,
+            'p_value': p_val,
+            'significant': p_val < 0.05
+        })
         anova_df = anova_df.sort_values('p_value')
         anova_df.to_csv(output_dir / "anova_results.csv", index=False)
 
@@ -222,6 +230,7 @@ def perform_anova_analysis(output_dir):
         return None
 
 if __name__ == "__main__":
+
     print("=" * 60)
     print("Multi-Omics Integration and Correlation Analysis")
     print("=" * 60)
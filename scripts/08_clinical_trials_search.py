@@ -13,6 +13,12 @@ from datetime import datetime
 OUTPUT_DIR = Path("results/clinical_trials")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Fields of each trial record, in output column order
+TRIAL_COLUMNS = [
+    "nct_id", "title", "condition", "status", "sponsor", "phase", "enrollment",
+    "start_date", "completion_date", "biomarkers", "url"
+]
+
 def search_clinical_trials(keywords, condition="Infection", status="Recruiting"):
     """
     Search ClinicalTrials.gov for relevant trials
@@ -109,42 +115,32 @@ def search_clinical_trials(keywords, condition="Infection", status="Recruiting")
 
     return filtered_trials
 
-def match_trials_to_biomarkers(trials, biomarkers):
-    """Match identified biomarkers to clinical trials"""
+def match_trials_to_biomarkers(trials_df, biomarkers):
+    """Match identified biomarkers to clinical trials (one row per trial in trials_df)"""
 
     print(f"\nMatching {len(biomarkers)} biomarkers to trials...")
 
-    matches = []
-
-    for trial in trials:
-        trial_biomarkers = set(trial.get("biomarkers", []))
-        user_biomarkers = set(biomarkers)
+    user_biomarkers = set(biomarkers)
 
-        overlap = trial_biomarkers & user_biomarkers
-        overlap_pct = len(overlap) / len(user_biomarkers) * 100 if user_biomarkers else 0
+    if trials_df.empty or not user_biomarkers:
+        return pd.DataFrame()
 
-        if len(overlap) > 0:
-            matches.append({
-                "nct_id": trial["nct_id"],
-                "title": trial["title"],
-                "matching_biomarkers": ", ".join(overlap),
-                "match_percentage": overlap_pct,
-                "phase": trial["phase"],
-                "status": trial["status"],
-                "sponsor": trial["sponsor"],
-                "enrollment": trial["enrollment"],
-                "url": trial["url"]
-            })
+    # One row per (trial, biomarker), keeping the user's biomarkers once per trial
+    hits = trials_df["biomarkers"].explode()
+    hits = hits[hits.isin(user_biomarkers)].groupby(level=0).unique()
 
-    matches_df = pd.DataFrame(matches)
+    matches_df = trials_df.loc[hits.index, ["nct_id", "title"]].assign(
+        matching_biomarkers=hits.map(", ".join),
+        match_percentage=hits.map(len) / len(user_biomarkers) * 100
+    ).join(trials_df[["phase", "status", "sponsor", "enrollment", "url"]])
 
     if len(matches_df) > 0:
         matches_df = matches_df.sort_values("match_percentage", ascending=False)
 
     return matches_df
 
-def create_trial_summary_report(trials, output_dir):
-    """Create a comprehensive summary report of clinical trials"""
+def create_trial_summary_report(trials_df, output_dir):
+    """Create a comprehensive summary report of clinical trials (one row per trial in trials_df)"""
 
     report_lines = [
         "=" * 80,
@@ -155,28 +151,19 @@ def create_trial_summary_report(trials, output_dir):
         ""
     ]
 
-    # Summary statistics
-    statuses = {}
-    phases = {}
-    total_enrollment = 0
-
-    for trial in trials:
-        status = trial["status"]
-        statuses[status] = statuses.get(status, 0) + 1
-
-        phase = trial["phase"]
-        phases[phase] = phases.get(phase, 0) + 1
-
-        total_enrollment += trial["enrollment"]
+    # Summary statistics (value_counts orders by count, most common first)
+    statuses = trials_df["status"].value_counts()
+    phases = trials_df["phase"].value_counts()
+    total_enrollment = int(trials_df["enrollment"].sum())
 
     report_lines.extend([
-        f"Total Trials: {len(trials)}",
+        f"Total Trials: {len(trials_df)}",
         f"Total Enrollment: {total_enrollment:,} patients",
         "",
         "Status Distribution:",
     ])
 
-    for status, count in sorted(statuses.items(), key=lambda x: x[1], reverse=True):
+    for status, count in statuses.items():
         report_lines.append(f"  {status}: {count} trials")
 
     report_lines.extend([
@@ -184,7 +171,7 @@ def create_trial_summary_report(trials, output_dir):
         "Phase Distribution:",
     ])
 
-    for phase, count in sorted(phases.items(), key=lambda x: x[1], reverse=True):
+    for phase, count in phases.items():
         report_lines.append(f"  {phase}: {count} trials")
 
     report_lines.extend([
@@ -195,17 +182,18 @@ def create_trial_summary_report(trials, output_dir):
         ""
     ])
 
-    for trial in sorted(trials, key=lambda x: x["start_date"], reverse=True):
+    for trial in trials_df.sort_values("start_date", ascending=False, kind="stable").itertuples():
+        biomarkers = trial.biomarkers if isinstance(trial.biomarkers, list) else []
         report_lines.extend([
-            f"Trial ID: {trial['nct_id']}",
-            f"Title: {trial['title']}",
-            f"Status: {trial['status']}",
-            f"Phase: {trial['phase']}",
-            f"Sponsor: {trial['sponsor']}",
-            f"Enrollment: {trial['enrollment']} patients",
-            f"Start: {trial['start_date']} | Completion: {trial['completion_date']}",
-            f"Key Biomarkers: {', '.join(trial.get('biomarkers', []))}",
-            f"Link: {trial['url']}",
+            f"Trial ID: {trial.nct_id}",
+            f"Title: {trial.title}",
+            f"Status: {trial.status}",
+            f"Phase: {trial.phase}",
+            f"Sponsor: {trial.sponsor}",
+            f"Enrollment: {trial.enrollment} patients",
+            f"Start: {trial.start_date} | Completion: {trial.completion_date}",
+            f"Key Biomarkers: {', '.join(biomarkers)}",
+            f"Link: {trial.url}",
             ""
         ])
 
@@ -215,9 +203,9 @@ def create_trial_summary_report(trials, output_dir):
         f.write(report_text)
 
     print("\nClinical Trials Summary:")
-    print(f"  Total trials: {len(trials)}")
+    print(f"  Total trials: {len(trials_df)}")
     print(f"  Total enrollment: {total_enrollment:,}")
-    print(f"  Phases: {list(phases.keys())}")
+    print(f"  Phases: {list(trials_df['phase'].unique())}")
 
     return report_text
 
@@ -237,13 +225,13 @@ if __name__ == "__main__":
     # Search for clinical trials
     trials = search_clinical_trials(biomarkers, condition="Infection", status="All")
 
-    # Save trial data
-    trials_df = pd.DataFrame(trials)
+    # Save trial data; the same table feeds the matching and the report
+    trials_df = pd.DataFrame(trials, columns=TRIAL_COLUMNS)
     trials_df.to_csv(OUTPUT_DIR / "all_clinical_trials.csv", index=False)
 
     # Match biomarkers to trials
     print("\nMatching biomarkers to trials...")
-    matches_df = match_trials_to_biomarkers(trials, biomarkers)
+    matches_df = match_trials_to_biomarkers(trials_df, biomarkers)
 
     if len(matches_df) > 0:
         matches_df.to_csv(OUTPUT_DIR / "matched_trials.csv", index=False)
@@ -252,7 +240,7 @@ if __name__ == "__main__":
 
     # Create summary report
     print("\nGenerating comprehensive report...")
-    report = create_trial_summary_report(trials, OUTPUT_DIR)
+    report = create_trial_summary_report(trials_df, OUTPUT_DIR)
 
     print("\n" + "=" * 60)
     print("Clinical trials search complete!")
@@ -0,0 +1,134 @@
+"""
+Shared helpers for the analysis pipeline scripts
+Imported by the numbered scripts, which cannot import one another
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Parquet is the canonical pipeline format; CSV copies are kept for inspection
+# unless PIPELINE_EXPORT_CSV=0
+EXPORT_CSV = os.environ.get("PIPELINE_EXPORT_CSV", "1") != "0"
+
+# Regenerate example input data even when cached copies exist in data/raw
+FORCE_REGEN = os.environ.get("PIPELINE_FORCE_REGEN", "0") != "0"
+
+# Sample metadata shared by all omics layers
+SAMPLE_METADATA_PATH = Path("data/raw/sample_metadata.parquet")
+
+# Worker processes for parallelised steps; defaults to all cores
+N_CPUS = int(os.environ.get("PIPELINE_N_CPUS", os.cpu_count() or 1))
+if N_CPUS < 1:
+    raise ValueError(f"PIPELINE_N_CPUS must be a positive integer, got {N_CPUS}")
+
+def save_table(df, path, index=False):
+    """Write df to path as zstd-compressed Parquet, plus a .csv copy if enabled"""
+    # Write then rename so concurrently running scripts never read a partial file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    df.to_parquet(tmp_path, compression="zstd", index=index)
+    os.replace(tmp_path, path)
+    if EXPORT_CSV:
+        df.to_csv(path.with_suffix(".csv"), index=index)
+
+def use_cached(*paths):
+    """True if every path exists and regeneration has not been forced"""
+    return not FORCE_REGEN and all(path.exists() for path in paths)
+
+def top_indices(values, n=10):
+    """Indices of the n largest values, in descending order of value
+
+    Uses a partial selection (np.argpartition) rather than sorting all values.
+    NaN values rank last, as in DataFrame.sort_values.
+    """
+    values = np.asarray(values, dtype=float)
+    values = np.where(np.isnan(values), -np.inf, values)
+    if len(values) > n:
+        idx = np.argpartition(values, -n)[-n:]
+    else:
+        idx = np.arange(len(values))
+    return idx[np.argsort(-values[idx], kind="stable")]
+
+def top_n(df, column, n=10):
+    """Rows of df with the n largest values in column, in descending order"""
+    return df.iloc[top_indices(df[column].to_numpy(), n)]
+
+def bh_adjust(pvalues):
+    """
+    Benjamini-Hochberg adjusted p-values
+    NaN p-values (constant or missing features) stay NaN and are left out of the
+    correction instead of turning every adjusted value into NaN
+    """
+    from statsmodels.stats.multitest import multipletests
+
+    pvalues = np.asarray(pvalues, dtype=float)
+    finite = np.isfinite(pvalues)
+    padj = np.full(pvalues.shape, np.nan)
+    if finite.any():
+        padj[finite] = multipletests(pvalues[finite], method="fdr_bh")[1]
+    return padj
+
+def get_sample_metadata(n_samples=24, sample_ids=None, path=SAMPLE_METADATA_PATH):
+    """
+    Sample metadata for the infection study design
+    An existing table at path is always used as-is (never overwritten) and must have
+    n_samples rows, and sample_ids if given; example metadata is only generated and
+    saved for example data (sample_ids not given) when the file is missing or
+    PIPELINE_FORCE_REGEN is set
+    """
+    if use_cached(path):
+        metadata = pd.read_parquet(path)
+        if len(metadata) != n_samples:
+            raise ValueError(f"{path} has {len(metadata)} samples but the data has {n_samples}; "
+                             "fix the metadata or remove it to regenerate the example design")
+        if sample_ids is not None and set(metadata["sample_id"]) != set(sample_ids):
+            raise ValueError(f"sample_id values in {path} do not match the data's sample columns")
+        return metadata
+
+    if sample_ids is not None:
+        # Real data was supplied; never pair it with an invented study design
+        raise FileNotFoundError(f"{path} is required to analyse the supplied data; "
+                                "see DATA_FORMAT.md for the sample metadata format")
+
+    idx = np.arange(n_samples)
+    half = n_samples // 2
+    metadata = pd.DataFrame({
+        "sample_id": [f"S{i+1:02d}" for i in idx],
+        "condition": np.where(idx < half, "Infected", "Control"),
+        "replicate": idx % half + 1
+    })
+    path.parent.mkdir(parents=True, exist_ok=True)
+    save_table(metadata, path)
+    return metadata
+
+def network_layout(G, seed=42, sfdp_min_nodes=200):
+    """
+    Node positions for drawing G
+    Graphs with at least sfdp_min_nodes nodes use the multilevel SFDP layout from
+    graph-tool or Graphviz when either is installed; smaller graphs, or environments
+    without them, use NetworkX's spring layout
+    """
+    import networkx as nx
+
+    if G.number_of_nodes() >= sfdp_min_nodes:
+        try:
+            import graph_tool.all as gt
+
+            nodes = list(G.nodes())
+            index = {node: i for i, node in enumerate(nodes)}
+            g = gt.Graph(directed=False)
+            g.add_vertex(len(nodes))
+            g.add_edge_list([(index[u], index[v]) for u, v in G.edges()])
+            coords = gt.sfdp_layout(g).get_2d_array([0, 1]).T
+            return dict(zip(nodes, coords))
+        except ImportError:
+            pass
+
+        try:
+            return nx.nx_agraph.graphviz_layout(G, prog="sfdp")
+        except (ImportError, ValueError, OSError):
+            pass  # pygraphviz missing or the sfdp binary not on PATH
+
+    return nx.spring_layout(G, k=2, iterations=50, seed=seed)